@@ -1,17 +1,24 @@
+import asyncio
+import concurrent.futures
 import logging
-import json
+import orjson
 import os
 import re
 import sys
+import threading
+import time
 from datetime import datetime, timedelta
-import pytz
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from functools import partial
+from types import MappingProxyType
+from zoneinfo import ZoneInfo
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from io import BytesIO
-from tenacity import retry, stop_after_attempt, wait_exponential
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+import ahocorasick
 
 # Загрузка .env
 load_dotenv()
@@ -21,7 +28,10 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 GOOGLE_SHEET_ID = os.getenv('GOOGLE_SHEET_ID')
 SHEET_NAME = os.getenv('SHEET_NAME', 'Sheet1')  # По умолчанию
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-ALLOWED_USERS = os.getenv('ALLOWED_USERS', '').split(',')  # Список ID пользователей, разделённых запятыми
+# ID пользователей через запятую. frozenset — O(1) проверка на каждый апдейт,
+# пустые элементы от висячих запятых отбрасываются. Пустой список означает
+# «не пускать никого»: ненастроенный ALLOWED_USERS не открывает бота всем
+ALLOWED_USERS = frozenset(x.strip() for x in os.getenv('ALLOWED_USERS', '').split(',') if x.strip())
 
 # Проверяем импорты и файлы конфигурации
 try:
@@ -34,23 +44,32 @@ except ImportError as e:
     sys.exit(1)
 
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI
     print("✅ OpenAI модуль загружен")
 except ImportError as e:
     print(f"❌ Ошибка импорта OpenAI: {e}")
     print("Установите: pip install openai")
     sys.exit(1)
 
-# Московское время
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+# Московское время (zoneinfo из stdlib — быстрее pytz и без лишней зависимости)
+MOSCOW_TZ = ZoneInfo('Europe/Moscow')
 
 def get_moscow_time():
     """Возвращает текущее московское время"""
     return datetime.now(MOSCOW_TZ)
 
+# Дата меняется раз в сутки, а format_moscow_date зовётся на каждую запись —
+# кэшируем отформатированную строку на текущую секунду: тот же выигрыш,
+# но смена суток подхватывается сразу, а не с минутным лагом
+_DATE_CACHE = {'ts': -1, 'val': ''}
+
 def format_moscow_date():
     """Возвращает дату в московском времени в формате ДД.ММ.ГГГГ"""
-    return get_moscow_time().strftime('%d.%m.%Y')
+    now = int(time.time())
+    if now != _DATE_CACHE['ts']:
+        _DATE_CACHE['val'] = datetime.now(MOSCOW_TZ).strftime('%d.%m.%Y')
+        _DATE_CACHE['ts'] = now
+    return _DATE_CACHE['val']
 
 # Настройка логирования с файлом
 logging.basicConfig(
@@ -60,13 +79,73 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Кэш для данных Sheets
-SHEETS_CACHE = None
-CACHE_TIMESTAMP = None
-CACHE_TIMEOUT = timedelta(minutes=5)  # Кэшируем на 5 минут
+# Переиспользуемая фигура для графиков: один Figure на процесс вместо
+# создания и уничтожения на каждый запрос аналитики (экономит настройку
+# фигуры и 1-2 МБ удерживаемого Agg-канваса за вызов)
+_CHART_FIG = None
+_CHART_LOCK = threading.Lock()
+
+def _get_chart_figure():
+    """Лениво создаёт переиспользуемую Agg-фигуру"""
+    global _CHART_FIG
+    if _CHART_FIG is None:
+        # Figure напрямую, минуя pyplot: не тянем state-machine pyplot,
+        # фигура не регистрируется в глобальном менеджере, а канвас
+        # всегда Agg. dpi=80 хватает для пирога в чате Telegram
+        from matplotlib.figure import Figure
+        _CHART_FIG = Figure(figsize=(5, 5), dpi=80)
+    return _CHART_FIG
+
+# Кэш для данных Sheets: один DataFrame вместо списка dict-ов
+# (get_all_records() пересоздаёт dict на каждую строку — мегабайты
+# накладных расходов на растущей таблице). Бот — единственный писатель
+# таблицы, поэтому кэш не перечитывается по таймеру: каждая запись/правка/
+# удаление обновляет его на месте, а полная загрузка происходит только на
+# старте или после явной инвалидации.
+HEADERS = ["Дата", "Тип операции", "Категория", "Описание/Получатель", "Сумма", "Комментарий"]
+# Служебная колонка кэша: физический номер строки записи в Sheets
+SHEET_ROW_COL = "_sheet_row"
+# Текстовые колонки, по которым работает /search
+SEARCH_TEXT_COLS = ("Тип операции", "Категория", "Описание/Получатель", "Комментарий")
+SHEETS_CACHE = None  # pd.DataFrame или None
+# Кэш читают рабочие потоки (to_thread, пул gspread), а мутирует в основном
+# цикл событий; RLock закрывает гонку «чтение во время drop/sort на месте».
+# Reentrant, потому что сборка кэша внутри блокировки пишет Parquet-снимок
+_CACHE_LOCK = threading.RLock()
+# Число записей леджера, поддерживается при каждой мутации кэша. Нужно
+# путям вроде delete_last, которым важен только номер последней строки:
+# читать счётчик дешевле, чем трогать кэш и рисковать сетевым фетчем.
+SHEETS_ROW_COUNT = 0
+
+# Высококардинальные текстовые колонки держим как arrow-строки: сплошной
+# буфер вместо объекта на ячейку, а str.contains уходит в SIMD-ядро Arrow.
+# Без установленного pyarrow тихо остаёмся на object-строках.
+try:
+    import pyarrow  # noqa: F401
+    STRING_DTYPE = pd.StringDtype('pyarrow')
+except ImportError:
+    STRING_DTYPE = None
+
+# Retry только вокруг сетевых вызовов: раньше он оборачивал всю
+# инициализацию, и отсутствующий credentials.json перепроверялся трижды
+# с экспоненциальной паузой (~20 с) вместо мгновенного падения
+_network_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=1, max=5),
+    retry=retry_if_exception_type((gspread.exceptions.APIError, ConnectionError))
+)
+
+@_network_retry
+def _open_worksheet(gc):
+    """Открывает рабочий лист (сетевой вызов — с retry)"""
+    return gc.open_by_key(GOOGLE_SHEET_ID).worksheet(SHEET_NAME)
+
+@_network_retry
+def _read_headers(sheet):
+    """Читает строку заголовков (сетевой вызов — с retry)"""
+    return sheet.row_values(1)
 
 # Инициализация с проверкой ошибок
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
 def initialize_services():
     """Инициализирует все внешние сервисы с проверкой ошибок и retry"""
     services = {}
@@ -75,7 +154,7 @@ def initialize_services():
     try:
         if not OPENAI_API_KEY:
             raise ValueError("OpenAI API ключ не настроен в .env")
-        services['openai'] = OpenAI(api_key=OPENAI_API_KEY)
+        services['openai'] = AsyncOpenAI(api_key=OPENAI_API_KEY)
         print("✅ OpenAI клиент инициализирован")
     except Exception as e:
         print(f"❌ Ошибка инициализации OpenAI: {e}")
@@ -93,12 +172,12 @@ def initialize_services():
         if not GOOGLE_SHEET_ID:
             raise ValueError("Google Sheet ID не настроен в .env")
             
-        services['sheets'] = gc.open_by_key(GOOGLE_SHEET_ID).worksheet(SHEET_NAME)
+        services['sheets'] = _open_worksheet(gc)
         print("✅ Google Sheets подключены")
         
         # Проверяем структуру таблицы
         try:
-            headers = services['sheets'].row_values(1)
+            headers = _read_headers(services['sheets'])
             if not headers:
                 services['sheets'].append_row(["Дата", "Тип операции", "Категория", "Описание/Получатель", "Сумма", "Комментарий"])
                 print("✅ Заголовки таблицы созданы")
@@ -131,74 +210,183 @@ if not SERVICES:
 client = SERVICES['openai']
 finance_sheet = SERVICES['sheets']
 
-# Хранилище последних операций и контекста (с сохранением в файл)
+# Выделенный ограниченный пул для синхронного gspread. asyncio.to_thread
+# использует общий executor (min(32, cpu+4) потоков) — на всплеске трафика
+# вызовы Sheets выедают его целиком и голодят остальной I/O. Восемь воркеров
+# заодно естественно ограничивают параллелизм запросов к Sheets.
+SHEETS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix='gspread')
+
+async def run_sheets(func, *args, **kwargs):
+    """Выполняет синхронный вызов gspread в выделенном пуле"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(SHEETS_EXECUTOR, partial(func, *args, **kwargs))
+
+# Хранилище последних операций и контекста (с сохранением в файл).
+# Раньше каждая операция переписывала весь user_context.json целиком —
+# O(вся история) дискового I/O на сообщение. Теперь операции дописываются
+# в append-only журнал (одна строка JSONL), а фоновая задача периодически
+# сворачивает журнал в компактный снапшот.
 USER_LAST_OPERATIONS = {}
 USER_CONTEXT = {}
-CONTEXT_FILE = 'user_context.json'
+CONTEXT_FILE = 'user_context.json'        # Компактный снапшот
+CONTEXT_LOG_FILE = 'user_context.jsonl'   # Append-only журнал операций
+COMPACT_INTERVAL = 300  # Секунд между компактированиями журнала
 
 def load_context():
-    """Загружает контекст из файла"""
+    """Загружает контекст: снапшот + проигрывание журнала"""
     global USER_CONTEXT
     if os.path.exists(CONTEXT_FILE):
-        with open(CONTEXT_FILE, 'r', encoding='utf-8') as f:
-            USER_CONTEXT = json.load(f)
+        with open(CONTEXT_FILE, 'rb') as f:
+            USER_CONTEXT = orjson.loads(f.read())
         print("✅ Контекст загружен из файла")
-
-def save_context():
-    """Сохраняет контекст в файл"""
-    with open(CONTEXT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(USER_CONTEXT, f, ensure_ascii=False, indent=2)
+    if os.path.exists(CONTEXT_LOG_FILE):
+        with open(CONTEXT_LOG_FILE, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # Оборванная строка после падения — пропускаем
+                ctx = USER_CONTEXT.setdefault(entry['u'], {'recent_operations': []})
+                ops = ctx['recent_operations']
+                ops.append(entry['l'])
+                del ops[:-10]
+                ctx.pop('joined', None)  # Склейка из снапшота устарела — пересоберётся
+        print("✅ Журнал контекста проигран")
+
+def append_context_op(user_id, context_line):
+    """Дописывает одну операцию в журнал контекста — O(1) вместо полной перезаписи"""
+    with open(CONTEXT_LOG_FILE, 'ab') as f:  # orjson отдаёт bytes
+        f.write(orjson.dumps({'u': user_id, 'l': context_line}) + b'\n')
+
+def compact_context():
+    """Сворачивает журнал в компактный снапшот (атомарно через os.replace)"""
+    tmp = CONTEXT_FILE + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(orjson.dumps(USER_CONTEXT))
+    os.replace(tmp, CONTEXT_FILE)
+    open(CONTEXT_LOG_FILE, 'w').close()  # Журнал учтён в снапшоте
+
+async def compact_worker():
+    """Фоновая задача: периодически компактирует журнал контекста"""
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+        try:
+            compact_context()
+        except Exception as e:
+            logger.error(f"Ошибка компактирования контекста: {e}")
 
 load_context()  # Загружаем при старте
 
+# Очередь отложенных записей в Sheets. Каждое сообщение раньше делало
+# отдельный append_row (синхронный HTTP-запрос), что упирается в квоту
+# Google 60 записей/мин. Теперь строки копятся и сбрасываются пачкой
+# одним запросом раз в FLUSH_INTERVAL секунд.
+PENDING_APPENDS = asyncio.Queue(maxsize=500)
+PENDING_EDITS = []  # Отложенные правки: {'range': ..., 'values': ...}
+FLUSH_INTERVAL = 2.0  # Секунд между сбросами очереди
+FLUSH_BATCH_LIMIT = 50  # Максимум строк в одном batch-запросе
+
+# Повторы вокруг batch-записи: transient 429 и сетевые сбои гасятся на
+# уровне HTTP-вызова, прежде чем flush_worker начнёт спасать очередь
+_append_rows_retrying = _network_retry(finance_sheet.append_rows)
+_batch_update_retrying = _network_retry(finance_sheet.spreadsheet.values_batch_update)
+
+async def flush_worker():
+    """Фоновая задача: сбрасывает накопленные строки в Sheets одним запросом"""
+    while True:
+        rows = []
+        try:
+            rows.append(await asyncio.wait_for(PENDING_APPENDS.get(), timeout=FLUSH_INTERVAL))
+        except asyncio.TimeoutError:
+            pass
+        while len(rows) < FLUSH_BATCH_LIMIT and not PENDING_APPENDS.empty():
+            rows.append(PENDING_APPENDS.get_nowait())
+
+        if not rows and not PENDING_EDITS:
+            continue
+
+        appended = False
+        try:
+            if rows:
+                # gspread синхронный — уводим HTTP-запрос в выделенный пул
+                await run_sheets(
+                    _append_rows_retrying,
+                    rows,
+                    value_input_option='USER_ENTERED',
+                    insert_data_option='INSERT_ROWS'
+                )
+            appended = True
+            if PENDING_EDITS:
+                edits, PENDING_EDITS[:] = PENDING_EDITS[:], []
+                try:
+                    await run_sheets(
+                        _batch_update_retrying,
+                        {'valueInputOption': 'RAW', 'data': edits}
+                    )
+                except Exception:
+                    PENDING_EDITS[:0] = edits  # Вернём правки на повтор
+                    raise
+            # Таблица и кэш сошлись — обновляем Parquet-снимок для рестарта
+            await asyncio.to_thread(_save_cache_snapshot)
+        except Exception as e:
+            logger.error(f"Ошибка batch-записи в Sheets: {e}")
+            # Пользователю уже подтверждена запись — после исчерпанных
+            # повторов возвращаем строки в очередь, а не теряем их. Кэш не
+            # сбрасываем: он опережает таблицу ровно на содержимое очереди
+            if rows and not appended:
+                try:
+                    for row in rows:
+                        PENDING_APPENDS.put_nowait(row)
+                except asyncio.QueueFull:
+                    # Часть строк спасти не удалось — кэш разошёлся с
+                    # таблицей, принудительно перечитаем
+                    logger.error("Очередь записи переполнена, кэш сброшен")
+                    invalidate_cache()
+        finally:
+            # Учёт для PENDING_APPENDS.join(): пути вроде delete_last ждут,
+            # пока взятые из очереди строки будут обработаны
+            for _ in rows:
+                PENDING_APPENDS.task_done()
+
+# Известные имена с падежными формами. Словарь заморожен на уровне модуля,
+# чтобы не пересоздавать его при каждом вызове normalize_name
+NAME_MAPPINGS = {
+    'интигаму': 'Интигам', 'интигама': 'Интигам',
+    'балтики': 'Балтика', 'балтике': 'Балтика', 'балтику': 'Балтика',
+    'петрову': 'Петров', 'петрова': 'Петров',
+    'рустаму': 'Рустам', 'рустама': 'Рустам',
+}
+
+# Падежные окончания и длина среза — один проход вместо двух групп endswith
+NAME_SUFFIXES = (('ом', 2), ('ым', 2), ('у', 1), ('а', 1), ('е', 1))
+
 def normalize_name(name):
     """Нормализует имя, убирая падежные окончания"""
     name_lower = name.lower()
-    if name_lower.endswith(('у', 'а', 'е', 'ом', 'ым')):
-        base = name[:-1] if not (name_lower.endswith('ом') or name_lower.endswith('ым')) else name[:-2]
-        return base.capitalize()
-    # Известные имена
-    mappings = {
-        'интигаму': 'Интигам', 'интигама': 'Интигам',
-        'балтики': 'Балтика', 'балтике': 'Балтика', 'балтику': 'Балтика',
-        'петрову': 'Петров', 'петрова': 'Петров',
-        'рустаму': 'Рустам', 'рустама': 'Рустам',
-    }
-    return mappings.get(name_lower, name.capitalize())
-
-def analyze_message_with_ai(text, user_context=None):
-    """Анализирует сообщение с помощью ИИ с учетом контекста"""
-    try:
-        # Сначала проверяем, не является ли это командным запросом
-        command_result = parse_voice_command(text)
-        if command_result:
-            return command_result
-
-        context_info = ""
-        if user_context:
-            recent_operations = user_context.get('recent_operations', [])
-            if recent_operations:
-                context_info = f"""
-КОНТЕКСТ последних операций пользователя:
-{chr(10).join(recent_operations[-5:])}
+    # Сначала известные имена — один hash-lookup, точнее эвристики
+    known = NAME_MAPPINGS.get(name_lower)
+    if known:
+        return known
+    for suffix, cut in NAME_SUFFIXES:
+        if name_lower.endswith(suffix):
+            return name[:-cut].capitalize()
+    return name.capitalize()
+
+# Статическая часть промпта. Вынесена в константу, чтобы OpenAI кэшировал её
+# как неизменный префикс (prompt caching): кэшированные токены дешевле в 2 раза
+# и не тратят время на prefill. Не меняйте текст между запусками без необходимости.
+SYSTEM_PROMPT = """
+Ты эксперт по анализу финансовых операций. Точность критически важна. При сомнениях - используй контекст и выбирай best fit.
 
-Используй этот контекст для более точного понимания. Например:
-- Если говорит "такая же сумма" - ищи в контексте
-- Если "тому же человеку" - используй имя из предыдущих операций
-- Если просто "зарплата" без имени - предложи уточнить или используй контекст
-"""
-
-        prompt = f"""
 Проанализируй сообщение пользователя и определи его тип и данные.
 
-{context_info}
-
-Сообщение: "{text}"
-
 Верни JSON в следующем формате:
 
 Для ФИНАНСОВЫХ операций:
-{{
+{
     "type": "finance",
     "operation_type": "Пополнение" или "Расход",
     "amount": число (положительное для пополнения, отрицательное для расхода),
@@ -206,14 +394,14 @@ def analyze_message_with_ai(text, user_context=None):
     "description": "краткое описание с именами людей",
     "comment": "",
     "confidence": число от 0 до 1 (насколько уверен в распознавании)
-}}
+}
 
 Если НЕЯСНО или нужно УТОЧНЕНИЕ:
-{{
+{
     "type": "clarification",
     "message": "Уточняющий вопрос пользователю",
     "suggestions": ["вариант 1", "вариант 2", "вариант 3"]
-}}
+}
 
 ПРАВИЛА РАСПОЗНАВАНИЯ:
 
@@ -263,25 +451,83 @@ def analyze_message_with_ai(text, user_context=None):
 ВАЖНО: Приоритет ключевым фразам (поставщику > имя). Если ambiguously, используй контекст для best fit. Анализируй весь текст для точного определения!
 """
 
-        response = client.chat.completions.create(
+# Кэш результатов ИИ-анализа: пользователи часто повторяют одинаковые
+# формулировки ("Балтика 5000" дважды, или голосом и затем текстом).
+# Попадание в кэш — мгновенный ответ без трат на токены. functools.lru_cache
+# не работает с корутинами, поэтому обычный dict с вытеснением старейшего.
+AI_CACHE = {}
+AI_CACHE_LIMIT = 512
+
+async def analyze_message_with_ai(text, user_context=None):
+    """Анализирует сообщение с помощью ИИ, кэшируя повторные запросы"""
+    recent_ops = (user_context or {}).get('recent_operations', [])
+    cache_key = (text.strip().lower(), tuple(recent_ops[-5:]))
+    cached = AI_CACHE.get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
+    analysis = await _analyze_message_uncached(text, user_context)
+
+    # Уточнения и ошибки не кэшируем — пусть следующая попытка пройдёт заново
+    if analysis.get('type') != 'clarification':
+        if len(AI_CACHE) >= AI_CACHE_LIMIT:
+            AI_CACHE.pop(next(iter(AI_CACHE)))
+        AI_CACHE[cache_key] = dict(analysis)
+    return analysis
+
+async def _analyze_message_uncached(text, user_context=None):
+    """Анализирует сообщение с помощью ИИ с учетом контекста"""
+    try:
+        # Сначала проверяем, не является ли это командным запросом
+        command_result = parse_voice_command(text)
+        if command_result:
+            return command_result
+
+        context_info = ""
+        if user_context:
+            recent_operations = user_context.get('recent_operations', [])
+            if recent_operations:
+                # Склейка кэшируется в контексте и обновляется только при
+                # новой операции — без join на каждый запрос к модели
+                joined = user_context.get('joined')
+                if joined is None:
+                    joined = '\n'.join(recent_operations[-5:])
+                    user_context['joined'] = joined
+                context_info = f"""
+КОНТЕКСТ последних операций пользователя:
+{joined}
+
+Используй этот контекст для более точного понимания. Например:
+- Если говорит "такая же сумма" - ищи в контексте
+- Если "тому же человеку" - используй имя из предыдущих операций
+- Если просто "зарплата" без имени - предложи уточнить или используй контекст
+"""
+
+        # Динамическая часть минимальна: только сообщение и контекст пользователя
+        user_prompt = f'Сообщение: "{text}"\n{context_info}'
+
+        response = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": "Ты эксперт по анализу финансовых операций. Точность критически важна. При сомнениях - используй контекст и выбирай best fit."},
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
             ],
+            response_format={"type": "json_object"},  # Гарантированно валидный JSON, без markdown-обёрток
             temperature=0.2  # Лёгкий креатив для лучшего понимания
         )
 
-        result = response.choices[0].message.content.strip()
-        # Убираем markdown форматирование если есть
-        if result.startswith("```json"):
-            result = result[7:-3]
-        elif result.startswith("```"):
-            result = result[3:-3]
+        result = response.choices[0].message.content
 
         try:
-            return json.loads(result)
-        except json.JSONDecodeError as e:
+            return orjson.loads(result)
+        except orjson.JSONDecodeError as e:
+            # Фоллбек для моделей без response_format: выдёргиваем JSON-блок
+            match = JSON_RE.search(result)
+            if match:
+                try:
+                    return orjson.loads(match.group(0))
+                except orjson.JSONDecodeError:
+                    pass
             logger.error(f"Ошибка парсинга JSON от ИИ: {e}")
             return {"type": "clarification", "message": "Ошибка анализа. Попробуйте переформулировать.", "suggestions": []}
 
@@ -289,6 +535,39 @@ def analyze_message_with_ai(text, user_context=None):
         logger.error(f"Ошибка ИИ анализа: {e}")
         return {"type": "clarification", "message": "Извините, произошла ошибка. Попробуйте переформулировать.", "suggestions": []}
 
+async def submit_batch_analysis(message_sets):
+    """Отправляет пачку chat-запросов через OpenAI Batch API.
+
+    Для фоновой аналитики (дайджесты, сводки по расписанию) задержка в
+    часы не важна, а Batch API даёт до 50% скидки на токены. Интерактивный
+    разбор сообщений пользователя остаётся на обычном низколатентном пути.
+    message_sets — список messages-списков для chat.completions.
+    Возвращает id батча для последующего retrieve_batch_analysis.
+    """
+    lines = [orjson.dumps({
+        'custom_id': f'analysis-{i}',
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': {'model': 'gpt-4o-mini', 'messages': messages}
+    }) for i, messages in enumerate(message_sets)]
+    buf = BytesIO(b'\n'.join(lines))
+    buf.name = 'batch_analysis.jsonl'
+    batch_file = await client.files.create(file=buf, purpose='batch')
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint='/v1/chat/completions',
+        completion_window='24h'
+    )
+    return batch.id
+
+async def retrieve_batch_analysis(batch_id):
+    """Забирает результаты батча; None — если батч ещё не готов"""
+    batch = await client.batches.retrieve(batch_id)
+    if batch.status != 'completed':
+        return None
+    content = await client.files.content(batch.output_file_id)
+    return [orjson.loads(line) for line in content.content.splitlines() if line]
+
 def update_user_context(user_id, operation_data):
     """Обновляет контекст пользователя"""
     if user_id not in USER_CONTEXT:
@@ -303,9 +582,38 @@ def update_user_context(user_id, operation_data):
     if len(USER_CONTEXT[user_id]['recent_operations']) > 10:
         USER_CONTEXT[user_id]['recent_operations'] = USER_CONTEXT[user_id]['recent_operations'][-10:]
 
-    save_context()  # Сохраняем после обновления
+    # Пересобираем склейку для промпта один раз здесь, а не на каждый LLM-вызов
+    USER_CONTEXT[user_id]['joined'] = '\n'.join(USER_CONTEXT[user_id]['recent_operations'][-5:])
 
-def add_finance_record(data, user_id):
+    append_context_op(user_id, context_line)  # Одна строка в журнал вместо полной перезаписи
+
+def _append_row_to_cache(row):
+    """Дописывает строку в кэш, не дожидаясь flush (синхронно, для to_thread).
+
+    Берёт _CACHE_LOCK (может ждать за аналитикой в соседнем потоке) и на
+    холодном кэше тянет всю таблицу — потому вызывается вне цикла событий.
+    Возвращает новое число записей.
+    """
+    global SHEETS_CACHE
+    # Расширение через df.loc[len(df)] теряло бы расширенные dtypes
+    # (category и arrow-строки деградируют в object, float32 — в float64),
+    # поэтому приводим однострочный DataFrame к типам кэша и конкатенируем
+    with _CACHE_LOCK:
+        df = _get_cached_frame_locked()
+        _ensure_categories(df, row[1], row[2])
+        # append_rows дописывает в конец таблицы: данные занимают строки
+        # 2..N+1 сплошняком, так что новая строка — len(df) + 2
+        addition = pd.DataFrame(
+            [[pd.to_datetime(row[0], format='%d.%m.%Y')] + row[1:] + [len(df) + 2]],
+            columns=HEADERS + [SHEET_ROW_COL],
+        ).astype(df.dtypes.to_dict())
+        df = pd.concat([df, addition], ignore_index=True)
+        SHEETS_CACHE = df
+        _set_row_count(len(df))
+        _bump_cache_version()
+        return len(df)
+
+async def add_finance_record(data, user_id):
     """Добавляет финансовую запись в таблицу"""
     try:
         row = [
@@ -316,14 +624,19 @@ def add_finance_record(data, user_id):
             data['amount'],
             data.get('comment', '')
         ]
-        finance_sheet.append_row(row)
-        invalidate_cache()  # Инвалидируем кэш после изменения
+        # Оптимистичный ответ: строка уходит в очередь, flush_worker
+        # запишет её пачкой вместе с соседними
+        PENDING_APPENDS.put_nowait(row)
+
+        # Мутация кэша — в потоке: холодная загрузка и ожидание блокировки
+        # не должны останавливать цикл событий на самом горячем пути
+        n_records = await asyncio.to_thread(_append_row_to_cache, row)
 
         # Сохраняем последнюю операцию
         USER_LAST_OPERATIONS[user_id] = {
             'type': 'finance',
             'data': data,
-            'row': len(get_cached_records()),
+            'row': n_records,
             'timestamp': get_moscow_time()
         }
 
@@ -338,93 +651,308 @@ def add_finance_record(data, user_id):
 def edit_finance_record(row_number, data):
     """Редактирует запись в таблице по номеру строки"""
     try:
-        cells = finance_sheet.range(f'A{row_number}:F{row_number}')
-        cells[0].value = data.get('date', format_moscow_date())
-        cells[1].value = data['operation_type']
-        cells[2].value = data['category']
-        cells[3].value = data['description']
-        cells[4].value = data['amount']
-        cells[5].value = data.get('comment', '')
-        finance_sheet.update_cells(cells)
-        invalidate_cache()
+        # Правка накапливается и уходит одним values_batch_update из flush_worker
+        new_row = [
+            data.get('date', format_moscow_date()),
+            data['operation_type'],
+            data['category'],
+            data['description'],
+            data['amount'],
+            data.get('comment', '')
+        ]
+        PENDING_EDITS.append({
+            'range': f'{SHEET_NAME}!A{row_number}:F{row_number}',
+            'values': [new_row]
+        })
+        # Правим и кэш: строку ищем по номеру в Sheets, позиция в
+        # отсортированном по дате кэше с порядком таблицы не совпадает
+        with _CACHE_LOCK:
+            if SHEETS_CACHE is not None:
+                pos = SHEETS_CACHE.index[SHEETS_CACHE[SHEET_ROW_COL] == row_number]
+                if len(pos):
+                    _ensure_categories(SHEETS_CACHE, new_row[1], new_row[2])
+                    SHEETS_CACHE.loc[pos[0], HEADERS] = \
+                        [pd.to_datetime(new_row[0], format='%d.%m.%Y', errors='coerce')] + new_row[1:]
+                    # Правка даты могла нарушить сортировку — восстанавливаем
+                    if not SHEETS_CACHE['Дата'].is_monotonic_increasing:
+                        SHEETS_CACHE.sort_values('Дата', inplace=True, na_position='last')
+                        SHEETS_CACHE.reset_index(drop=True, inplace=True)
+                    _bump_cache_version()
         return True
     except Exception as e:
         logger.error(f"Ошибка редактирования записи: {e}")
         return False
 
-def delete_finance_record(row_number):
+async def delete_finance_record(row_number):
     """Удаляет запись по номеру строки"""
     try:
-        finance_sheet.delete_rows(row_number)
-        invalidate_cache()
+        if row_number < 2:
+            # Строка 1 — заголовки; их удаление молча ломает таблицу
+            logger.error(f"Отказ удалять строку {row_number}: это заголовки")
+            return False
+        await run_sheets(finance_sheet.delete_rows, row_number)
+        # Убираем строку из кэша: ищем по номеру в Sheets, не по позиции
+        snapshot_needed = False
+        with _CACHE_LOCK:
+            if SHEETS_CACHE is not None:
+                pos = SHEETS_CACHE.index[SHEETS_CACHE[SHEET_ROW_COL] == row_number]
+                if len(pos):
+                    SHEETS_CACHE.drop(index=pos, inplace=True)
+                    # Строки ниже удалённой поднимаются в таблице на одну
+                    SHEETS_CACHE.loc[SHEETS_CACHE[SHEET_ROW_COL] > row_number, SHEET_ROW_COL] -= 1
+                    SHEETS_CACHE.reset_index(drop=True, inplace=True)
+                    _set_row_count(len(SHEETS_CACHE))
+                    _bump_cache_version()
+                    snapshot_needed = True
+        if snapshot_needed:
+            await asyncio.to_thread(_save_cache_snapshot)
         return True
     except Exception as e:
         logger.error(f"Ошибка удаления записи: {e}")
         return False
 
-def clear_table():
+async def clear_table():
     """Очищает всю таблицу, кроме заголовков"""
     try:
         # Получаем все строки кроме первой (заголовки)
-        records = finance_sheet.get_all_values()
+        records = await run_sheets(finance_sheet.get_all_values)
         if len(records) > 1:
-            finance_sheet.delete_rows(2, len(records) - 1)  # Удаляем с 2-й строки
+            await run_sheets(finance_sheet.delete_rows, 2, len(records) - 1)  # Удаляем с 2-й строки
         invalidate_cache()
+        _set_row_count(0)
         print("✅ Таблица очищена")
         return True
     except Exception as e:
         logger.error(f"Ошибка очистки таблицы: {e}")
         return False
 
-def get_cached_records():
-    """Получает записи из кэша или обновляет"""
-    global SHEETS_CACHE, CACHE_TIMESTAMP
-    now = datetime.now()
-    if SHEETS_CACHE is None or CACHE_TIMESTAMP is None or now - CACHE_TIMESTAMP > CACHE_TIMEOUT:
-        SHEETS_CACHE = finance_sheet.get_all_records()
-        CACHE_TIMESTAMP = now
-        print("✅ Кэш Sheets обновлён")
+# Версия кэша: растёт при каждой мутации. Служит ключом для мемоизации
+# производных результатов (агрегаты, отчёты) — сменилась версия, значит
+# кэшированный результат устарел.
+SHEETS_CACHE_VERSION = 0
+
+def records_cache_version():
+    """Текущая версия кэша записей"""
+    return SHEETS_CACHE_VERSION
+
+def _bump_cache_version():
+    global SHEETS_CACHE_VERSION
+    SHEETS_CACHE_VERSION += 1
+
+def _set_row_count(count):
+    global SHEETS_ROW_COUNT
+    SHEETS_ROW_COUNT = count
+
+# Опциональное numba-ядро для сумм по категориям. На типичном размере
+# леджера pandas groupby и так быстр, поэтому ядро включается явно через
+# USE_NUMBA=1 — имеет смысл от ~10^5 строк. Суммирование по кодам категорий
+# идёт серийно: параллельный scatter-инкремент в prange был бы гонкой.
+USE_NUMBA = os.getenv('USE_NUMBA', '').lower() in ('1', 'true', 'yes')
+if USE_NUMBA:
+    try:
+        from numba import njit
+
+        @njit(cache=True)
+        def _group_sum_kernel(codes, values, n_groups):
+            out = np.zeros(n_groups, np.float64)
+            counts = np.zeros(n_groups, np.int64)
+            for i in range(codes.size):
+                out[codes[i]] += values[i]
+                counts[codes[i]] += 1
+            return out, counts
+    except ImportError:
+        USE_NUMBA = False
+
+def sum_by_category(df):
+    """Суммы расходов/доходов по категориям.
+
+    С USE_NUMBA=1 считает по целочисленным кодам категорий вручную,
+    иначе — обычный pandas groupby. Возвращает только наблюдаемые
+    категории, как groupby(observed=True).
+    """
+    if USE_NUMBA and isinstance(df['Категория'].dtype, pd.CategoricalDtype):
+        codes = df['Категория'].cat.codes.to_numpy(np.int64)
+        valid = codes >= 0  # -1 = NaN-категория
+        codes = codes[valid]
+        values = df['Сумма'].to_numpy(np.float64)[valid]
+        cats = df['Категория'].cat.categories
+        totals, counts = _group_sum_kernel(codes, values, len(cats))
+        result = pd.Series(totals, index=cats)
+        return result[counts > 0]
+    return df.groupby('Категория', observed=True)['Сумма'].sum()
+
+# Общие агрегаты по расходам для топ-N отчётов. Раньше получатели,
+# поставщики и категории делали независимые проходы по одним и тем же
+# данным; теперь всё считается одним заходом и мемоизируется по версии
+# леджера — до следующей записи отчёты отдаются из кэша.
+_BUNDLE_CACHE = {'version': None, 'bundle': None}
+
+def analytics_bundle():
+    """Возвращает словарь агрегатов расходов, кэшированный по версии кэша"""
+    with _CACHE_LOCK:
+        version = records_cache_version()
+        if _BUNDLE_CACHE['version'] != version:
+            df = _get_cached_frame_locked()
+            neg = df[df['Сумма'] < 0]
+            suppliers = neg[neg['Категория'] == 'Оплата поставщику']
+            _BUNDLE_CACHE['bundle'] = {
+                'by_category': sum_by_category(neg),
+                'by_recipient': neg.groupby('Описание/Получатель')['Сумма'].sum(),
+                'by_supplier': suppliers.groupby('Описание/Получатель')['Сумма'].sum(),
+            }
+            _BUNDLE_CACHE['version'] = version
+        return _BUNDLE_CACHE['bundle']
+
+def _ensure_categories(df, operation_type, category):
+    """Расширяет категориальные колонки перед вставкой новых значений"""
+    for col, val in (('Тип операции', operation_type), ('Категория', category)):
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and val not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories([val])
+
+# Parquet-снимок типизированного кэша. Холодный старт читает один
+# колоночный файл вместо фетча всей таблицы и перепарсивания дат/сумм;
+# снимок обновляется после каждой записи в Sheets. Бот — единственный
+# писатель таблицы, поэтому снимок расходится с ней только при ошибке
+# записи — тогда invalidate_cache() его удаляет.
+PARQUET_CACHE_FILE = 'finance_cache.parquet'
+_PARQUET_CHECKED = False  # Снимок читаем только один раз, при старте
+
+def _save_cache_snapshot():
+    """Сбрасывает кэш в Parquet (best-effort, требует pyarrow)"""
+    with _CACHE_LOCK:
+        if SHEETS_CACHE is None or STRING_DTYPE is None:
+            return
+        try:
+            tmp_file = PARQUET_CACHE_FILE + '.tmp'
+            SHEETS_CACHE.to_parquet(tmp_file, compression='zstd')
+            os.replace(tmp_file, PARQUET_CACHE_FILE)  # Атомарная подмена
+        except Exception as e:
+            logger.error(f"Ошибка сохранения Parquet-снимка: {e}")
+
+def _load_cache_snapshot():
+    """Читает Parquet-снимок; None, если его нет или он не читается"""
+    if STRING_DTYPE is None or not os.path.exists(PARQUET_CACHE_FILE):
+        return None
+    try:
+        df = pd.read_parquet(PARQUET_CACHE_FILE)
+        if SHEET_ROW_COL not in df.columns:
+            return None  # Снимок старого формата — перечитаем таблицу
+        return df
+    except Exception as e:
+        logger.error(f"Ошибка чтения Parquet-снимка: {e}")
+        return None
+
+def get_cached_frame():
+    """Возвращает типизированный DataFrame; загружает из Sheets только при пустом кэше"""
+    global SHEETS_CACHE, _PARQUET_CHECKED
+    with _CACHE_LOCK:
+        return _get_cached_frame_locked()
+
+def _get_cached_frame_locked():
+    global SHEETS_CACHE, _PARQUET_CHECKED
+    if SHEETS_CACHE is None:
+        df = None
+        if not _PARQUET_CHECKED:
+            _PARQUET_CHECKED = True
+            df = _load_cache_snapshot()
+            if df is not None:
+                print("✅ Кэш Sheets загружен из Parquet-снимка")
+        if df is None:
+            values = finance_sheet.get_all_values()
+            df = pd.DataFrame(values[1:], columns=HEADERS) if len(values) > 1 else pd.DataFrame(columns=HEADERS)
+            # Физический номер строки в Sheets. Кэш отсортирован по дате и
+            # потому не совпадает с порядком таблицы — правки и удаления
+            # находят свою строку по этой колонке, а не по позиции
+            df[SHEET_ROW_COL] = np.arange(2, len(df) + 2)
+            # Типизируем один раз здесь, а не в каждом обработчике: строковые
+            # даты и суммы больше нигде не перепарсиваются. Колонки с малым числом
+            # уникальных значений храним как category: ~49 байт накладных расходов
+            # на каждый Python-str уходят, а groupby идёт по целочисленным кодам
+            df['Дата'] = pd.to_datetime(df['Дата'], format='%d.%m.%Y', errors='coerce', cache=True)
+            df['Сумма'] = pd.to_numeric(df['Сумма'], errors='coerce', downcast='float').fillna(0)
+            for col in ('Тип операции', 'Категория'):
+                df[col] = df[col].astype('category')
+            # Описание почти уникально на запись — category не сэкономит,
+            # а вот arrow-строки и компактнее, и быстрее сканируются
+            if STRING_DTYPE is not None:
+                df['Описание/Получатель'] = df['Описание/Получатель'].astype(STRING_DTYPE)
+            # Держим леджер отсортированным по дате: фильтр по периоду режет срез
+            # двоичным поиском вместо полного скана (новые записи дописываются с
+            # сегодняшней датой и порядок не нарушают)
+            df.sort_values('Дата', inplace=True, na_position='last')
+            df.reset_index(drop=True, inplace=True)
+            print("✅ Кэш Sheets обновлён")
+        SHEETS_CACHE = df
+        _set_row_count(len(df))
+        _bump_cache_version()
+        _save_cache_snapshot()
     return SHEETS_CACHE
 
 def invalidate_cache():
-    """Инвалидирует кэш"""
-    global SHEETS_CACHE, CACHE_TIMESTAMP
-    SHEETS_CACHE = None
-    CACHE_TIMESTAMP = None
+    """Сбрасывает кэш — следующий доступ перечитает таблицу"""
+    global SHEETS_CACHE
+    with _CACHE_LOCK:
+        SHEETS_CACHE = None
+        _bump_cache_version()
+        # Снимку больше нет доверия — убираем, чтобы не ожил при рестарте
+        try:
+            os.remove(PARQUET_CACHE_FILE)
+        except FileNotFoundError:
+            pass
+
+# Фразы голосовых команд в порядке приоритета (как в старом каскаде if-ов:
+# "анализ получателей" должно побеждать "анализ"). Вместо ~30 отдельных
+# `in`-проверок на сообщение все фразы ищутся одним проходом автомата
+# Ахо-Корасик, собранного один раз при импорте.
+COMMAND_PHRASES = {
+    'recipients': ['кому платили', 'анализ получателей', 'по получателям', 'кому больше', 'топ получателей'],
+    'suppliers': ['анализ поставщика', 'по поставщику', 'история с', 'поставщик'],
+    'categories': ['по категориям', 'категории', 'расходы по'],
+    'analytics': ['анализ', 'аналитика', 'отчет', 'покажи траты', 'сколько потратили'],
+    'search': ['найди', 'найти', 'поиск', 'покажи операции', 'когда платили'],
+    'history': ['история', 'последние операции', 'что было'],
+    'backup': ['бэкап', 'резервная копия', 'сохрани', 'backup'],
+}
+
+COMMAND_AC = ahocorasick.Automaton()
+for _rank, (_cmd, _phrases) in enumerate(COMMAND_PHRASES.items()):
+    for _phrase in _phrases:
+        COMMAND_AC.add_word(_phrase, (_rank, _cmd))
+COMMAND_AC.make_automaton()
 
 def parse_voice_command(text):
     """Парсит голосовые команды и возвращает соответствующую команду"""
-    text_lower = text.lower()
-
-    # Команды по получателям
-    if any(phrase in text_lower for phrase in ['кому платили', 'анализ получателей', 'по получателям', 'кому больше', 'топ получателей']):
-        return {"type": "voice_command", "command": "recipients", "params": text}
-
-    # Команды по поставщикам
-    if any(phrase in text_lower for phrase in ['анализ поставщика', 'по поставщику', 'история с', 'поставщик']):
-        return {"type": "voice_command", "command": "suppliers", "params": text}
-
-    # Команды по категориям
-    if any(phrase in text_lower for phrase in ['по категориям', 'категории', 'расходы по']):
-        return {"type": "voice_command", "command": "categories", "params": text}
+    best = None
+    for _, match in COMMAND_AC.iter(text.lower()):
+        if best is None or match[0] < best[0]:
+            best = match
+    if best:
+        return {"type": "voice_command", "command": best[1], "params": text}
+    return None
 
-    # Команды аналитики
-    if any(phrase in text_lower for phrase in ['анализ', 'аналитика', 'отчет', 'покажи траты', 'сколько потратили']):
-        return {"type": "voice_command", "command": "analytics", "params": text}
+# Скомпилированный один раз паттерн имён/компаний (слова с заглавной буквы)
+NAME_RE = re.compile(r'\b[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?\b')
 
-    # Команды поиска
-    if any(phrase in text_lower for phrase in ['найди', 'найти', 'поиск', 'покажи операции', 'когда платили']):
-        return {"type": "voice_command", "command": "search", "params": text}
+# Фоллбек-извлечение JSON-блока из ответа модели без response_format
+JSON_RE = re.compile(r'\{.*\}', re.S)
 
-    # Команды истории
-    if any(phrase in text_lower for phrase in ['история', 'последние операции', 'что было']):
-        return {"type": "voice_command", "command": "history", "params": text}
+# Названия месяцев для извлечения периода из запроса и номера месяцев
+# для аналитики; собраны один раз на модуль вместо литералов в хендлерах
+_MONTHS = MappingProxyType({
+    'январь': 1, 'февраль': 2, 'март': 3, 'апрель': 4, 'май': 5, 'июнь': 6,
+    'июль': 7, 'август': 8, 'сентябрь': 9, 'октябрь': 10, 'ноябрь': 11, 'декабрь': 12,
+})
+MONTH_NAMES = tuple(_MONTHS)
 
-    # Команды бэкапа
-    if any(phrase in text_lower for phrase in ['бэкап', 'резервная копия', 'сохрани', 'backup']):
-        return {"type": "voice_command", "command": "backup", "params": text}
+# «Неделя» только в падежных формах существительного: голый префикс
+# 'недел' ловил и «понедельник», превращая его в семидневный период
+_WEEK_RE = re.compile(r'недел[юяие]')
 
-    return None
+# Относительные периоды аналитики: имя -> начало интервала от текущего момента
+_PERIOD_STARTS = MappingProxyType({
+    'неделя': lambda now: now - timedelta(days=7),
+    'месяц': lambda now: now - timedelta(days=30),
+})
 
 def extract_params_from_voice(text, command_type):
     """Извлекает параметры из голосового запроса"""
@@ -432,21 +960,20 @@ def extract_params_from_voice(text, command_type):
     params = {}
 
     # Извлекаем имена/компании
-    names = re.findall(r'\b[А-ЯЁ][а-яё]+(?:\s+[А-ЯЁ][а-яё]+)?\b', text)
+    names = NAME_RE.findall(text)
     if names:
         params['name'] = normalize_name(names[0])
 
     # Извлекаем периоды
-    if any(word in text_lower for word in ['неделя', 'неделю']):
+    if _WEEK_RE.search(text_lower):
         params['period'] = 'неделя'
-    elif any(word in text_lower for word in ['месяц']):
+    elif 'месяц' in text_lower:
         params['period'] = 'месяц'
-    elif any(word in text_lower for word in ['декабрь', 'январь', 'февраль', 'март', 'апрель', 'май', 'июнь', 'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь']):
-        months = ['январь', 'февраль', 'март', 'апрель', 'май', 'июнь', 'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь']
-        for month in months:
-            if month in text_lower:
-                params['period'] = month
-                break
+    else:
+        # Один проход по месяцам с ранним выходом вместо двойного скана
+        month = next((m for m in MONTH_NAMES if m in text_lower), None)
+        if month:
+            params['period'] = month
 
     # Извлекаем категории
     if any(word in text_lower for word in ['зарплат', 'зарплаты']):
@@ -458,59 +985,65 @@ def extract_params_from_voice(text, command_type):
 
     return params
 
-def create_quick_buttons():
-    """Создает быстрые кнопки для частых действий"""
-    keyboard = [
-        [
-            InlineKeyboardButton("📊 Отчет", callback_data="quick_analytics"),
-            InlineKeyboardButton("🔍 Поиск", callback_data="quick_search")
-        ],
-        [
-            InlineKeyboardButton("📋 История", callback_data="quick_history"),
-            InlineKeyboardButton("💾 Бэкап", callback_data="quick_backup")
-        ],
-        [
-            InlineKeyboardButton("📂 Категории", callback_data="quick_categories"),
-            InlineKeyboardButton("👥 Получатели", callback_data="quick_recipients")
-        ],
-        [
-            InlineKeyboardButton("🏭 Поставщики", callback_data="quick_suppliers"),
-            InlineKeyboardButton("✏️ Редактировать", callback_data="quick_edit")
-        ],
-        [
-            InlineKeyboardButton("🗑️ Удалить", callback_data="quick_delete")
-        ]
+# Статичные клавиатуры собираются один раз при импорте: содержимое не
+# меняется, а пересоздание девяти InlineKeyboardButton на каждый /start —
+# лишние аллокации на каждом нажатии
+
+# Быстрые кнопки для частых действий
+QUICK_BUTTONS = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📊 Отчет", callback_data="quick_analytics"),
+        InlineKeyboardButton("🔍 Поиск", callback_data="quick_search")
+    ],
+    [
+        InlineKeyboardButton("📋 История", callback_data="quick_history"),
+        InlineKeyboardButton("💾 Бэкап", callback_data="quick_backup")
+    ],
+    [
+        InlineKeyboardButton("📂 Категории", callback_data="quick_categories"),
+        InlineKeyboardButton("👥 Получатели", callback_data="quick_recipients")
+    ],
+    [
+        InlineKeyboardButton("🏭 Поставщики", callback_data="quick_suppliers"),
+        InlineKeyboardButton("✏️ Редактировать", callback_data="quick_edit")
+    ],
+    [
+        InlineKeyboardButton("🗑️ Удалить", callback_data="quick_delete")
     ]
-    return InlineKeyboardMarkup(keyboard)
-
-def create_search_buttons():
-    """Создает кнопки для популярных поисковых запросов (без Петров/Интигам)"""
-    keyboard = [
-        [
-            InlineKeyboardButton("💰 Зарплаты", callback_data="search_зарплаты"),
-            InlineKeyboardButton("📊 Процент", callback_data="search_процент")
-        ],
-        [
-            InlineKeyboardButton("📅 За неделю", callback_data="search_неделя"),
-            InlineKeyboardButton("💸 >50000", callback_data="search_>50000")
-        ]
+])
+
+# Кнопки для популярных поисковых запросов (без Петров/Интигам)
+SEARCH_BUTTONS = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("💰 Зарплаты", callback_data="search_зарплаты"),
+        InlineKeyboardButton("📊 Процент", callback_data="search_процент")
+    ],
+    [
+        InlineKeyboardButton("📅 За неделю", callback_data="search_неделя"),
+        InlineKeyboardButton("💸 >50000", callback_data="search_>50000")
     ]
-    return InlineKeyboardMarkup(keyboard)
+])
+
+# Кнопки подтверждения параметризованы типом действия — кэшируем варианты
+_CONFIRMATION_BUTTONS = {}
 
 def create_confirmation_buttons(action_type):
-    """Создаёт кнопки для подтверждения"""
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Да", callback_data=f"confirm_{action_type}_yes"),
-            InlineKeyboardButton("❌ Нет", callback_data=f"confirm_{action_type}_no")
-        ]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    """Возвращает кнопки подтверждения (кэшируются по типу действия)"""
+    markup = _CONFIRMATION_BUTTONS.get(action_type)
+    if markup is None:
+        markup = InlineKeyboardMarkup([
+            [
+                InlineKeyboardButton("✅ Да", callback_data=f"confirm_{action_type}_yes"),
+                InlineKeyboardButton("❌ Нет", callback_data=f"confirm_{action_type}_no")
+            ]
+        ])
+        _CONFIRMATION_BUTTONS[action_type] = markup
+    return markup
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик голосовых сообщений"""
     user_id = str(update.effective_user.id)
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
+    if user_id not in ALLOWED_USERS:
         await update.message.reply_text("❌ Доступ запрещён.")
         return
 
@@ -518,23 +1051,23 @@ async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🎤 Распознаю голосовое сообщение...")
 
         voice_file = await context.bot.get_file(update.message.voice.file_id)
-        voice_path = f"voice_{update.message.voice.file_id}.ogg"
-        await voice_file.download_to_drive(voice_path)
-
-        with open(voice_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-                language="ru"
-            )
 
-        os.remove(voice_path)
+        # Качаем аудио сразу в память — без временного файла на диске
+        buf = BytesIO(await voice_file.download_as_bytearray())
+        buf.name = 'voice.ogg'  # OpenAI SDK определяет MIME по имени
+
+        transcript = await client.audio.transcriptions.create(
+            model="whisper-1",
+            file=buf,
+            language="ru"
+        )
+
         recognized_text = transcript.text
 
         await update.message.reply_text(f"📝 Распознал: \"{recognized_text}\"\nРаспознал правильно? Если нет, перефразируй.")
 
         user_context = USER_CONTEXT.get(user_id)
-        analysis = analyze_message_with_ai(recognized_text, user_context)
+        analysis = await analyze_message_with_ai(recognized_text, user_context)
 
         await process_analysis_result(update, analysis, user_id, f"🎤 \"{recognized_text}\"", context)
 
@@ -567,7 +1100,7 @@ async def handle_voice_command(update: Update, context: ContextTypes.DEFAULT_TYP
         else:
             await message.reply_text(
                 "🔍 **Голосовой поиск**\n\nПопробуйте сказать:\n• 'Найди Петрова'\n• 'Покажи операции за неделю'\n• 'Когда платили Интигаму'",
-                reply_markup=create_search_buttons()
+                reply_markup=SEARCH_BUTTONS
             )
     elif command == "history":
         await show_context_history(update, context)
@@ -594,7 +1127,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data == "quick_search":
             await message.edit_text(
                 "🔍 **Быстрый поиск**\n\nВыберите категорию или скажите что ищете:",
-                reply_markup=create_search_buttons()
+                reply_markup=SEARCH_BUTTONS
             )
         elif data == "quick_history":
             await show_context_history(update, context)
@@ -620,7 +1153,7 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             action = parts[1]
             choice = parts[2]
             if choice == "yes" and action == "clear":
-                if clear_table():
+                if await clear_table():
                     await message.edit_text("🗑️ Таблица полностью очищена!")
                 else:
                     await message.edit_text("❌ Ошибка очистки.")
@@ -634,9 +1167,26 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         logger.error(f"Ошибка в callback: {e}")
         await message.edit_text("❌ Ошибка при обработке кнопки.")
 
-async def process_analysis_result(update, analysis, user_id, source_info="", context=None):
-    """Обрабатывает результат анализа ИИ"""
+async def process_analysis_result(update, analysis, user_id, source_info="", context=None, placeholder=None):
+    """Обрабатывает результат анализа ИИ.
+
+    Если обработчик уже отправил сообщение-плейсхолдер ("Анализирую..."),
+    результат редактирует его вместо отправки второго сообщения — правки
+    не считаются в лимит 30 исходящих сообщений/с.
+    """
+    async def respond(text, **kwargs):
+        if placeholder is not None:
+            await placeholder.edit_text(text, **kwargs)
+        else:
+            await update.message.reply_text(text, **kwargs)
+
     if analysis["type"] == "voice_command":
+        if placeholder is not None:
+            # Команда ответит собственными сообщениями — плейсхолдер не нужен
+            try:
+                await placeholder.delete()
+            except Exception:
+                pass
         await handle_voice_command(update, context, analysis)
         return
 
@@ -655,10 +1205,10 @@ async def process_analysis_result(update, analysis, user_id, source_info="", con
 
 ✅ Записать? Или уточните что не так.
             """
-            await update.message.reply_text(confirm_text, parse_mode='Markdown', reply_markup=create_confirmation_buttons("finance"))
+            await respond(confirm_text, parse_mode='Markdown', reply_markup=create_confirmation_buttons("finance"))
             return
 
-        if add_finance_record(analysis, user_id):
+        if await add_finance_record(analysis, user_id):
             emoji = "📈" if analysis["operation_type"] == "Пополнение" else "📉"
             response = f"""
 {emoji} **Финансовая операция записана:**
@@ -673,13 +1223,13 @@ async def process_analysis_result(update, analysis, user_id, source_info="", con
 ✅ **Записано в Google Таблицу!**
             """
 
-            await update.message.reply_text(
+            await respond(
                 response,
                 parse_mode='Markdown',
-                reply_markup=create_quick_buttons()
+                reply_markup=QUICK_BUTTONS
             )
         else:
-            await update.message.reply_text("❌ Ошибка при записи в таблицу финансов.")
+            await respond("❌ Ошибка при записи в таблицу финансов.")
     else:
         suggestions = analysis.get('suggestions', [])
         response = f"❓ {analysis.get('message', 'Не понял ваше сообщение.')}"
@@ -689,16 +1239,10 @@ async def process_analysis_result(update, analysis, user_id, source_info="", con
             for i, suggestion in enumerate(suggestions[:3], 1):
                 response += f"{i}. {suggestion}\n"
 
-        await update.message.reply_text(response, parse_mode='Markdown')
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /start"""
-    user_id = str(update.effective_user.id)
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ Доступ запрещён.")
-        return
+        await respond(response, parse_mode='Markdown')
 
-    welcome_text = """
+# Приветствие полностью статично — формируем один раз
+WELCOME_TEXT = """
 💰 **Умный финансовый помощник с ИИ!**
 
 🎤 **Новинка: Голосовое управление!**
@@ -723,29 +1267,43 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Закупка Тула, Закупка Москва
 
 **Говорите естественно - бот всё поймет!**
-    """
+"""
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /start"""
+    user_id = str(update.effective_user.id)
+    if user_id not in ALLOWED_USERS:
+        await update.message.reply_text("❌ Доступ запрещён.")
+        return
 
     await update.message.reply_text(
-        welcome_text,
+        WELCOME_TEXT,
         parse_mode='Markdown',
-        reply_markup=create_quick_buttons()
+        reply_markup=QUICK_BUTTONS
     )
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений с контекстом"""
     user_id = str(update.effective_user.id)
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
+    if user_id not in ALLOWED_USERS:
         await update.message.reply_text("❌ Доступ запрещён.")
         return
 
     user_message = update.message.text
 
-    await update.message.reply_text("🤔 Анализирую с учетом контекста...")
-
     user_context = USER_CONTEXT.get(user_id)
-    analysis = analyze_message_with_ai(user_message, user_context)
 
-    await process_analysis_result(update, analysis, user_id, context=context)
+    # Плейсхолдер шлём только если анализ затянулся: быстрый путь (кэш,
+    # голосовая команда) обходится одним исходящим сообщением вместо двух
+    analysis_task = asyncio.create_task(analyze_message_with_ai(user_message, user_context))
+    placeholder = None
+    try:
+        analysis = await asyncio.wait_for(asyncio.shield(analysis_task), timeout=0.5)
+    except asyncio.TimeoutError:
+        placeholder = await update.message.reply_text("🤔 Анализирую с учетом контекста...")
+        analysis = await analysis_task
+
+    await process_analysis_result(update, analysis, user_id, context=context, placeholder=placeholder)
 
 async def show_context_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает историю с контекстом"""
@@ -765,14 +1323,14 @@ async def show_context_history(update: Update, context: ContextTypes.DEFAULT_TYP
         else:
             history = "📊 **Контекст пуст** - начните добавлять операции!\n\n"
 
-        finance_records = get_cached_records()
-        recent_finance = finance_records[-3:] if len(finance_records) > 3 else finance_records
+        # Холодный кэш тянет всю таблицу из Sheets — грузим вне цикла событий
+        recent_finance = (await asyncio.to_thread(get_cached_frame)).tail(3)
 
-        if recent_finance:
+        if not recent_finance.empty:
             history += "\n💰 **Последние финансовые операции:**\n"
-            for record in reversed(recent_finance):
-                emoji = "📈" if record.get('Сумма', 0) > 0 else "📉"
-                history += f"{emoji} {record.get('Описание/Получатель', '')}: {record.get('Сумма', 0):,.0f} ₽\n"
+            for desc, amount in zip(recent_finance['Описание/Получатель'][::-1], recent_finance['Сумма'][::-1]):
+                emoji = "📈" if amount > 0 else "📉"
+                history += f"{emoji} {desc}: {amount:,.0f} ₽\n"
 
         await message.reply_text(history, parse_mode='Markdown')
 
@@ -780,54 +1338,125 @@ async def show_context_history(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"Ошибка истории: {e}")
         await message.reply_text("❌ Ошибка при получении истории.")
 
+async def _settle_ack(ack_task):
+    """Дожидается фонового ack-сообщения перед следующей отправкой.
+
+    Гарантирует порядок сообщений в чате и забирает результат задачи;
+    неудачная отправка ack не должна ронять сам ответ — только лог.
+    """
+    try:
+        await ack_task
+    except Exception as e:
+        logger.error(f"Ошибка отправки ack-сообщения: {e}")
+
 async def show_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE, period=None):
     """Умная аналитика трат с параметрами периода и графиками"""
+    message = update.message if update.message else update.callback_query.message
+    # Ack уходит параллельно с расчётом — не ждём round-trip до Telegram
+    ack_task = asyncio.create_task(message.reply_text("📊 Анализирую ваши финансы..."))
     try:
-        message = update.message if update.message else update.callback_query.message
-        
-        await message.reply_text("📊 Анализирую ваши финансы...")
-
-        finance_records = pd.DataFrame(get_cached_records())
+        # Холодный кэш тянет всю таблицу из Sheets — грузим вне цикла событий
+        finance_records = await asyncio.to_thread(get_cached_frame)
 
         if finance_records.empty:
+            await _settle_ack(ack_task)
             await message.reply_text("📊 Нет данных для аналитики. Добавьте операции!")
             return
 
-        # Конвертируем даты в datetime (МСК), с обработкой ошибок
-        try:
-            finance_records['Дата'] = pd.to_datetime(finance_records['Дата'], format='%d.%m.%Y', errors='coerce').dt.tz_localize(MOSCOW_TZ)
-            finance_records = finance_records.dropna(subset=['Дата'])  # Удаляем некорректные даты
-        except Exception as date_e:
-            logger.error(f"Ошибка парсинга дат: {date_e}")
-            await message.reply_text("❌ Ошибка с датами в таблице. Проверьте формат ДД.ММ.ГГГГ.")
-            return
-
-        # Фильтр по периоду
-        now = get_moscow_time()
-        if period == 'неделя':
-            start_date = now - timedelta(days=7)
-        elif period == 'месяц':
-            start_date = now - timedelta(days=30)
-        elif period in ['январь', 'февраль', 'март', 'апрель', 'май', 'июнь', 'июль', 'август', 'сентябрь', 'октябрь', 'ноябрь', 'декабрь']:
-            month_num = {'январь':1, 'февраль':2, 'март':3, 'апрель':4, 'май':5, 'июнь':6, 'июль':7, 'август':8, 'сентябрь':9, 'октябрь':10, 'ноябрь':11, 'декабрь':12}[period]
-            start_date = datetime(now.year, month_num, 1, tzinfo=MOSCOW_TZ)
-        else:
-            start_date = now - timedelta(days=30)  # Default
-
-        recent_records = finance_records[finance_records['Дата'] >= start_date]
+        # Агрегаты, сборка отчёта и отрисовка — чистый CPU; уводим в поток,
+        # чтобы цикл событий продолжал обслуживать остальных пользователей
+        report, png = await asyncio.to_thread(_build_analytics_report, finance_records, period)
 
-        if recent_records.empty:
+        if report is None:
+            await _settle_ack(ack_task)
             await message.reply_text(f"📊 Нет данных за указанный период ({period or '30 дней'}).")
             return
 
-        total_income = recent_records[recent_records['Сумма'] > 0]['Сумма'].sum()
-        total_expense = recent_records[recent_records['Сумма'] < 0]['Сумма'].sum()
+        await _settle_ack(ack_task)
+        # Отчёт и диаграмма не зависят друг от друга — шлём одновременно,
+        # экономя один round-trip до Telegram
+        if png is not None:
+            await asyncio.gather(
+                message.reply_text(report, parse_mode='Markdown'),
+                context.bot.send_photo(chat_id=update.effective_chat.id, photo=BytesIO(png)),
+            )
+        else:
+            await message.reply_text(report, parse_mode='Markdown')
+
+    except Exception as e:
+        logger.error(f"Ошибка аналитики: {e}")
+        await _settle_ack(ack_task)
+        await message.reply_text("❌ Ошибка при создании аналитики. Проверьте логи.")
 
-        categories = recent_records[recent_records['Сумма'] < 0].groupby('Категория')['Сумма'].sum()
+# Готовые PNG диаграмм по ключу (период, версия кэша записей). Версия
+# растёт только при мутации леджера, так что устаревшие байты отдать
+# невозможно; вытеснение — FIFO, как в кэше ответов ИИ
+_CHART_PNG_CACHE = {}
+_CHART_PNG_LIMIT = 32
+
+def _render_categories_png(abs_categories):
+    """Рисует круговую диаграмму расходов и возвращает PNG-байты"""
+    # matplotlib по-прежнему импортируется лениво (внутри
+    # _get_chart_figure), фигура одна на процесс — очищаем и рисуем
+    with _CHART_LOCK:
+        fig = _get_chart_figure()
+        fig.clear()
+        ax = fig.add_subplot(111)
+        abs_categories.plot(kind='pie', ax=ax, autopct='%1.1f%%', title='Расходы по категориям')
+        buf = BytesIO()
+        fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+def _build_analytics_report(finance_records, period):
+    """Считает агрегаты за период и собирает отчёт с диаграммой.
+
+    Синхронная и CPU-тяжёлая часть show_analytics — вызывается через
+    asyncio.to_thread. Возвращает (текст, PNG-байты или None); если за
+    период нет записей — (None, None).
+    """
+    # Весь расчёт идёт под блокировкой кэша: цикл событий может править кадр на месте
+    with _CACHE_LOCK:
+        # Даты в кэше — наивные datetime64 в московском времени (леджер
+        # однозонный, tz_localize по всей колонке не нужен); сравниваем с
+        # такой же наивной границей — pandas идёт по int64-пути
+        finance_records = finance_records.dropna(subset=['Дата'])  # Удаляем некорректные даты
+
+        # Фильтр по периоду — словари собраны на уровне модуля
+        now = get_moscow_time().replace(tzinfo=None)
+        if period in _PERIOD_STARTS:
+            start_date = _PERIOD_STARTS[period](now)
+        elif period in _MONTHS:
+            start_date = datetime(now.year, _MONTHS[period], 1)
+        else:
+            start_date = now - timedelta(days=30)  # Default
 
-        salaries = recent_records[recent_records['Категория'] == 'Зарплаты сотрудникам'].groupby('Описание/Получатель')['Сумма'].sum().abs()
+        # Леджер отсортирован по дате — O(log N) поиск границы вместо
+        # булевой маски по всей колонке
+        start_idx = finance_records['Дата'].searchsorted(start_date, side='left')
+        recent_records = finance_records.iloc[start_idx:]
 
-        report = f"""
+        if recent_records.empty:
+            return None, None
+
+        # Маска расходов считается один раз: раньше `Сумма < 0` вычислялось
+        # трижды (итог, категории, зарплаты) плюс отдельное `Сумма > 0`
+        amounts = recent_records['Сумма'].to_numpy()
+        neg_mask = amounts < 0
+        expenses = recent_records[neg_mask]
+        total_expense = amounts[neg_mask].sum()
+        total_income = amounts[amounts > 0].sum()
+
+        categories = sum_by_category(expenses)
+        # Модули сумм и проценты считаем одним векторным проходом и
+        # переиспользуем в отчёте, топ-категории и круговой диаграмме
+        abs_categories = categories.abs()
+        percents = abs_categories / abs(total_expense) * 100 if total_expense != 0 else abs_categories * 0
+
+        salaries = expenses[expenses['Категория'] == 'Зарплаты сотрудникам'].groupby('Описание/Получатель')['Сумма'].sum().abs()
+
+        # Отчёт собираем списком строк и склеиваем один раз: += на str
+        # перевыделяет всю строку на каждой итерации
+        parts = [f"""
 📊 **Умная аналитика за период {period or '30 дней'}**
 
 💰 **Общие итоги:**
@@ -837,39 +1466,101 @@ async def show_analytics(update: Update, context: ContextTypes.DEFAULT_TYPE, per
 📊 Операций: {len(recent_records)}
 
 💸 **Расходы по категориям:**
-"""
+"""]
 
-        for cat, amount in categories.sort_values().items():
-            percent = abs(amount) / abs(total_expense) * 100 if total_expense != 0 else 0
-            report += f"• {cat}: {amount:,.0f} ₽ ({percent:.1f}%)\n"
+    for cat, amount in categories.sort_values().items():
+        parts.append(f"• {cat}: {amount:,.0f} ₽ ({percents[cat]:.1f}%)\n")
 
-        if not salaries.empty:
-            report += f"\n👥 **Зарплаты сотрудникам:**\n"
-            for person, amount in salaries.sort_values(ascending=False).items():
-                report += f"• {person}: {amount:,.0f} ₽\n"
+    if not salaries.empty:
+        parts.append("\n👥 **Зарплаты сотрудникам:**\n")
+        parts.extend(f"• {person}: {amount:,.0f} ₽\n" for person, amount in salaries.sort_values(ascending=False).items())
 
-        avg_daily = abs(total_expense) / ((now - start_date).days or 1)
-        report += f"\n📈 **Средние траты в день:** {avg_daily:,.0f} ₽"
+    avg_daily = abs(total_expense) / ((now - start_date).days or 1)
+    parts.append(f"\n📈 **Средние траты в день:** {avg_daily:,.0f} ₽")
 
-        if not categories.empty:
-            top_category = categories.idxmin()
-            report += f"\n🔝 **Больше всего тратите на:** {top_category}"
+    if not categories.empty:
+        top_category = abs_categories.idxmax()
+        parts.append(f"\n🔝 **Больше всего тратите на:** {top_category}")
 
-        await message.reply_text(report, parse_mode='Markdown')
+    report = "".join(parts)
 
-        # Генерация графика
-        if not categories.empty:
-            fig, ax = plt.subplots()
-            categories.abs().plot(kind='pie', ax=ax, autopct='%1.1f%%', title='Расходы по категориям')
-            buf = BytesIO()
-            fig.savefig(buf, format='png')
-            buf.seek(0)
-            await context.bot.send_photo(chat_id=update.effective_chat.id, photo=buf)
-            plt.close(fig)
+    # Диаграмма мемоизируется по (период, версия кэша): пока не было
+    # новых записей, повторный /analytics отдаёт готовый PNG без
+    # matplotlib и перекодирования
+    png = None
+    if not categories.empty:
+        chart_key = (period or '30 дней', records_cache_version())
+        png = _CHART_PNG_CACHE.get(chart_key)
+        if png is None:
+            png = _render_categories_png(abs_categories)
+            if len(_CHART_PNG_CACHE) >= _CHART_PNG_LIMIT:
+                _CHART_PNG_CACHE.pop(next(iter(_CHART_PNG_CACHE)))
+            _CHART_PNG_CACHE[chart_key] = png
 
-    except Exception as e:
-        logger.error(f"Ошибка аналитики: {e}")
-        await message.reply_text("❌ Ошибка при создании аналитики. Проверьте логи.")
+    return report, png
+
+def _build_search_report(finance_records, search_query):
+    """Фильтрует леджер по запросу и собирает текст выдачи.
+
+    Синхронная часть advanced_search — вызывается через asyncio.to_thread.
+    Возвращает None, если ничего не найдено.
+    """
+    # Скан под блокировкой кэша — кадр могут править на месте из цикла событий
+    with _CACHE_LOCK:
+        # Фильтры: числовые пороги проверяем первыми — текстовый скан для них
+        # не нужен. Порог распознаём строго по префиксу: '>' в середине текста
+        # больше не уводит запрос в числовую ветку, а нечисловой хвост
+        # ("<тысяча") мягко откатывается к текстовому поиску
+        mask = None
+        query = search_query.strip()
+        if query[:1] in '<>':
+            try:
+                thresh = float(query[1:].replace(',', '.'))
+            except ValueError:
+                pass  # Не число — ищем как обычный текст
+            else:
+                mask = finance_records['Сумма'] > thresh if query[0] == '>' else finance_records['Сумма'] < thresh
+        if mask is None:
+            # Векторный str.contains по текстовым колонкам вместо
+            # df.apply(..., axis=1): без Python-диспетчеризации на строку
+            mask = np.zeros(len(finance_records), dtype=bool)
+            for col in SEARCH_TEXT_COLS:
+                series = finance_records[col]
+                # Arrow-строки не прогоняем через astype — копия в
+                # python-бэкенд свела бы выигрыш на нет
+                if not isinstance(series.dtype, pd.StringDtype):
+                    series = series.astype('string')
+                mask |= series.str.contains(
+                    search_query, case=False, regex=False, na=False
+                ).to_numpy()
+
+        found_records = finance_records[mask]
+
+        if found_records.empty:
+            return None
+
+        found_records = found_records.sort_values('Дата', ascending=False)
+
+        display_records = found_records.head(15)
+
+        # Даты форматируем векторно одним dt.strftime, дальше идём по голым
+        # numpy-массивам — без распаковки Timestamp/Series на каждую строку
+        dates = display_records['Дата'].dt.strftime('%d.%m.%Y').to_numpy()
+        descs = display_records['Описание/Получатель'].to_numpy()
+        sums = display_records['Сумма'].to_numpy()
+
+        parts = [f"🔍 **Найдено: {len(found_records)} операций**\n\n"]
+        parts.extend(
+            f"{'📈' if s > 0 else '📉'} {d}: {desc} - {s:,.0f} ₽\n"
+            for d, desc, s in zip(dates, descs, sums)
+        )
+
+        if len(found_records) > 15:
+            parts.append(f"\n... и ещё {len(found_records) - 15} операций")
+
+        total_amount = found_records['Сумма'].sum()
+        parts.append(f"\n\n📊 **Общая сумма:** {total_amount:,.0f} ₽")
+        return "".join(parts)
 
 async def advanced_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Продвинутый поиск операций с использованием pandas"""
@@ -904,101 +1595,80 @@ async def advanced_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await message.reply_text(f"🔍 Ищу операции по запросу: '{search_query}'...")
 
-        finance_records = pd.DataFrame(get_cached_records())
+        # Холодный кэш тянет всю таблицу из Sheets — грузим вне цикла событий
+        finance_records = await asyncio.to_thread(get_cached_frame)
         if finance_records.empty:
             await message.reply_text("📊 Нет данных.")
             return
 
-        # Конвертируем для фильтров
-        finance_records['Сумма'] = pd.to_numeric(finance_records['Сумма'], errors='coerce')
-        finance_records['Дата'] = pd.to_datetime(finance_records['Дата'], format='%d.%m.%Y', errors='coerce')
-
-        # Фильтры
-        mask = finance_records.apply(lambda row: search_query in str(row).lower(), axis=1)
-        if '>' in search_query:
-            thresh = int(search_query.split('>')[1])
-            mask = finance_records['Сумма'] > thresh
-        elif '<' in search_query:
-            thresh = int(search_query.split('<')[1])
-            mask = finance_records['Сумма'] < thresh
-
-        found_records = finance_records[mask]
+        # Фильтрация и сборка выдачи — pandas по всему леджеру; в потоке,
+        # чтобы цикл событий не стоял на больших таблицах
+        result = await asyncio.to_thread(_build_search_report, finance_records, search_query)
 
-        if found_records.empty:
+        if result is None:
             await message.reply_text(f"❌ По запросу '{search_query}' ничего не найдено.")
             return
 
-        found_records = found_records.sort_values('Дата', ascending=False)
-
-        result = f"🔍 **Найдено: {len(found_records)} операций**\n\n"
-        
-        display_records = found_records.head(15)
-
-        for _, record in display_records.iterrows():
-            emoji = "📈" if record['Сумма'] > 0 else "📉"
-            result += f"{emoji} {record['Дата'].strftime('%d.%m.%Y')}: {record['Описание/Получатель']} - {record['Сумма']:,.0f} ₽\n"
-
-        if len(found_records) > 15:
-            result += f"\n... и ещё {len(found_records) - 15} операций"
-
-        total_amount = found_records['Сумма'].sum()
-        result += f"\n\n📊 **Общая сумма:** {total_amount:,.0f} ₽"
-
         await message.reply_text(result, parse_mode='Markdown')
 
     except Exception as e:
         logger.error(f"Ошибка поиска: {e}")
         await message.reply_text("❌ Ошибка при поиске операций.")
 
-async def create_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Создает резервную копию данных"""
-    message = update.message if update.message else update.callback_query.message
-    
-    try:
-        await message.reply_text("💾 Создаю резервную копию...")
-
-        finance_records = get_cached_records()
-
+def _serialize_backup():
+    """Готовит JSON-байты резервной копии (синхронно, для to_thread)"""
+    # Читаем кадр под блокировкой кэша — его могут править на месте; и
+    # сам кадр берём здесь же, чтобы холодная загрузка не попала в цикл
+    with _CACHE_LOCK:
+        df = _get_cached_frame_locked()
+        # Даты в кэше — Timestamp'ы; для JSON возвращаем исходный формат
+        finance_records = df.drop(columns=SHEET_ROW_COL).assign(Дата=df['Дата'].dt.strftime('%d.%m.%Y')).to_dict('records')
         backup_data = {
             'created': get_moscow_time().strftime('%d.%m.%Y %H:%M'),
             'finance_records': len(finance_records),
             'finance': finance_records
         }
+        return orjson.dumps(backup_data, option=orjson.OPT_INDENT_2), backup_data['created'], len(finance_records)
 
-        backup_filename = f"backup_{get_moscow_time().strftime('%Y%m%d_%H%M')}.json"
-        with open(backup_filename, 'w', encoding='utf-8') as f:
-            json.dump(backup_data, f, ensure_ascii=False, indent=2)
-
-        with open(backup_filename, 'rb') as f:
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=f,
-                filename=backup_filename,
-                caption=f"💾 **Резервная копия создана!**\n\n📊 Записей: {len(finance_records)}\n📅 Дата: {backup_data['created']}"
-            )
+async def create_backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Создает резервную копию данных"""
+    message = update.message if update.message else update.callback_query.message
+    # Ack не ждём — сериализация идёт, пока сообщение летит в Telegram
+    ack_task = asyncio.create_task(message.reply_text("💾 Создаю резервную копию..."))
+    try:
+        # Конвертация дат и сериализация — CPU, уводим в поток
+        payload, created, n_records = await asyncio.to_thread(_serialize_backup)
 
-        os.remove(backup_filename)
+        # Файл не пишем на диск вовсе — отдаём байты Telegram напрямую
+        backup_filename = f"backup_{get_moscow_time().strftime('%Y%m%d_%H%M')}.json"
+        await _settle_ack(ack_task)
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=InputFile(BytesIO(payload), filename=backup_filename),
+            caption=f"💾 **Резервная копия создана!**\n\n📊 Записей: {n_records}\n📅 Дата: {created}"
+        )
 
     except Exception as e:
         logger.error(f"Ошибка создания backup: {e}")
+        await _settle_ack(ack_task)
         await message.reply_text("❌ Ошибка при создании резервной копии.")
 
+def _top_series(key):
+    """Срез analytics_bundle по модулю и по убыванию (синхронно, для to_thread)"""
+    return analytics_bundle()[key].abs().sort_values(ascending=False)
+
 async def show_recipients(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Показывает анализ по получателям"""
     message = update.message if update.message else update.callback_query.message
     try:
         await message.reply_text("👥 Анализирую получателей...")
-        finance_records = pd.DataFrame(get_cached_records())
-        if finance_records.empty:
-            await message.reply_text("👥 Нет данных для анализа получателей.")
-            return
-        recipients = finance_records[finance_records['Сумма'] < 0].groupby('Описание/Получатель')['Сумма'].sum().abs().sort_values(ascending=False)
+        recipients = await asyncio.to_thread(_top_series, 'by_recipient')
         if recipients.empty:
             await message.reply_text("👥 Нет данных о получателях.")
             return
-        report = "👥 **Топ получателей:**\n"
-        for person, amount in recipients.head(10).items():
-            report += f"• {person}: {amount:,.0f} ₽\n"
+        report = "👥 **Топ получателей:**\n" + "".join(
+            f"• {person}: {amount:,.0f} ₽\n" for person, amount in recipients.head(10).items()
+        )
         await message.reply_text(report, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Ошибка анализа получателей: {e}")
@@ -1009,17 +1679,13 @@ async def show_suppliers(update: Update, context: ContextTypes.DEFAULT_TYPE, par
     message = update.message if update.message else update.callback_query.message
     try:
         await message.reply_text("🏭 Анализирую поставщиков...")
-        finance_records = pd.DataFrame(get_cached_records())
-        if finance_records.empty:
-            await message.reply_text("🏭 Нет данных для анализа поставщиков.")
-            return
-        suppliers = finance_records[(finance_records['Категория'] == 'Оплата поставщику') & (finance_records['Сумма'] < 0)].groupby('Описание/Получатель')['Сумма'].sum().abs().sort_values(ascending=False)
+        suppliers = await asyncio.to_thread(_top_series, 'by_supplier')
         if suppliers.empty:
             await message.reply_text("🏭 Нет данных о поставщиках.")
             return
-        report = "🏭 **Топ поставщиков:**\n"
-        for supplier, amount in suppliers.head(10).items():
-            report += f"• {supplier}: {amount:,.0f} ₽\n"
+        report = "🏭 **Топ поставщиков:**\n" + "".join(
+            f"• {supplier}: {amount:,.0f} ₽\n" for supplier, amount in suppliers.head(10).items()
+        )
         await message.reply_text(report, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Ошибка анализа поставщиков: {e}")
@@ -1030,17 +1696,13 @@ async def show_categories(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
     message = update.message if update.message else update.callback_query.message
     try:
         await message.reply_text("📂 Анализирую категории...")
-        finance_records = pd.DataFrame(get_cached_records())
-        if finance_records.empty:
-            await message.reply_text("📂 Нет данных для анализа категорий.")
-            return
-        categories = finance_records[finance_records['Сумма'] < 0].groupby('Категория')['Сумма'].sum().abs().sort_values(ascending=False)
+        categories = await asyncio.to_thread(_top_series, 'by_category')
         if categories.empty:
             await message.reply_text("📂 Нет данных о категориях.")
             return
-        report = "📂 **Расходы по категориям:**\n"
-        for cat, amount in categories.items():
-            report += f"• {cat}: {amount:,.0f} ₽\n"
+        report = "📂 **Расходы по категориям:**\n" + "".join(
+            f"• {cat}: {amount:,.0f} ₽\n" for cat, amount in categories.items()
+        )
         await message.reply_text(report, parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Ошибка анализа категорий: {e}")
@@ -1056,8 +1718,23 @@ async def delete_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     message = update.message if update.message else update.callback_query.message
     try:
-        last_row = len(get_cached_records()) + 1  # 1-based, headers
-        if delete_finance_record(last_row):
+        # Холодный старт: счётчик ещё не прогрет — загружаем кэш вне цикла
+        if SHEETS_CACHE is None:
+            await asyncio.to_thread(get_cached_frame)
+        # Даём очереди записи доехать до таблицы: иначе удаление целится
+        # в строку, которой в Sheets ещё нет
+        try:
+            await asyncio.wait_for(PENDING_APPENDS.join(), timeout=10)
+        except asyncio.TimeoutError:
+            await message.reply_text("⏳ Записи ещё сохраняются — попробуйте через пару секунд.")
+            return
+        if SHEETS_ROW_COUNT < 1:
+            await message.reply_text("📊 Нет операций для удаления.")
+            return
+        # Счётчик строк обновляется при каждой мутации — прогретый кэш
+        # больше не трогаем, чтобы не провоцировать лишний фетч
+        last_row = SHEETS_ROW_COUNT + 1  # 1-based, headers
+        if await delete_finance_record(last_row):
             await message.reply_text("🗑️ Последняя операция удалена.")
         else:
             await message.reply_text("❌ Ошибка удаления.")
@@ -1068,7 +1745,7 @@ async def delete_last(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clear_table_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда для полной очистки таблицы с подтверждением"""
     user_id = str(update.effective_user.id)
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
+    if user_id not in ALLOWED_USERS:
         await update.message.reply_text("❌ Доступ запрещён.")
         return
     await update.message.reply_text(
@@ -1085,6 +1762,22 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except:
         pass
 
+async def _start_background_tasks(application):
+    """Запускает фоновые задачи после старта event loop"""
+    application.create_task(flush_worker())
+    application.create_task(compact_worker())
+    print("✅ Фоновые задачи запущены (flush Sheets, компактирование контекста)")
+
+# Команды бота: имя -> обработчик. Регистрируются циклом в main()
+COMMAND_HANDLERS = (
+    ("start", start),
+    ("search", advanced_search),
+    ("history", show_context_history),
+    ("analytics", show_analytics),
+    ("backup", create_backup),
+    ("clear_table", clear_table_command),  # Полная очистка (с подтверждением)
+)
+
 def main():
     """Запуск продвинутого ИИ-бота"""
     print("🚀 Запускаю продвинутый ИИ финансовый бот...")
@@ -1094,24 +1787,22 @@ def main():
         if not TELEGRAM_TOKEN:
             print("❌ Telegram токен не настроен в .env")
             return
-        
-        application = Application.builder().token(TELEGRAM_TOKEN).build()
+
+        application = Application.builder().token(TELEGRAM_TOKEN).post_init(_start_background_tasks).build()
         print("✅ Telegram приложение создано")
     except Exception as e:
         print(f"❌ Ошибка создания Telegram приложения: {e}")
         return
 
-    # Добавляем обработчики
+    # Добавляем обработчики. block=False разрешает PTB обрабатывать
+    # перекрывающиеся апдейты параллельно — обработчики независимы, а
+    # тяжёлая работа и так уходит в потоки через to_thread/run_sheets
     try:
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("search", advanced_search))
-        application.add_handler(CommandHandler("history", show_context_history))
-        application.add_handler(CommandHandler("analytics", show_analytics))
-        application.add_handler(CommandHandler("backup", create_backup))
-        application.add_handler(CommandHandler("clear_table", clear_table_command))  # Новая команда
-        application.add_handler(CallbackQueryHandler(handle_callback_query))
-        application.add_handler(MessageHandler(filters.VOICE, handle_voice))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+        for command, callback in COMMAND_HANDLERS:
+            application.add_handler(CommandHandler(command, callback, block=False))
+        application.add_handler(CallbackQueryHandler(handle_callback_query, block=False))
+        application.add_handler(MessageHandler(filters.VOICE, handle_voice, block=False))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message, block=False))
         application.add_error_handler(error_handler)
         print("✅ Обработчики добавлены")
     except Exception as e: